@@ -23,12 +23,17 @@ index = {"Config": "00_learner.ipynb",
          "get_default_shapes": "01_models.ipynb",
          "show": "02_data.ipynb",
          "DeformationField": "02_data.ipynb",
+         "BatchDeformation": "02_data.ipynb",
+         "LazyImage": "02_data.ipynb",
+         "ImageCache": "02_data.ipynb",
          "BaseDataset": "02_data.ipynb",
          "RandomTileDataset": "02_data.ipynb",
          "TileDataset": "02_data.ipynb",
+         "TileDataLoader": "02_data.ipynb",
          "preprocess_mask": "02a_transforms.ipynb",
          "create_pdf": "02a_transforms.ipynb",
          "random_center": "02a_transforms.ipynb",
+         "CenterSampler": "02a_transforms.ipynb",
          "calculate_weights": "02a_transforms.ipynb",
          "lambda_kernel": "02a_transforms.ipynb",
          "SeparableConv2D": "02a_transforms.ipynb",
@@ -3,12 +3,46 @@
 __all__ = ['ElasticDeformCallback']
 
 # Cell
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from fastai.callback.core import Callback
 
 # Cell
 class ElasticDeformCallback(Callback):
     "`Callback` that recomputes elastic deformations after each epoch"
     run_valid = False
+    def before_fit(self):
+        "Start computing the deformations of the next epoch in a background thread"
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.next_augmentation = self._submit()
+
+    @property
+    def _in_workers(self):
+        "DataLoader workers create their own augmentations (see `RandomTileDataset._sync_worker_epoch`)"
+        dl = self.learn.dls.train
+        # fastai keeps the number of workers of the torch DataLoader in `fake_l`
+        return getattr(getattr(dl, 'fake_l', dl), 'num_workers', 0)>0 and hasattr(dl.dataset, '_sync_worker_epoch')
+
+    def _submit(self):
+        ds = self.learn.dls.train.dataset
+        if self._in_workers: return None
+        # The thread draws from its own generator, seeded from the main process (reproducible with `set_seed`)
+        if hasattr(ds, 'create_augmentation'): return self.executor.submit(ds.create_augmentation, rng=np.random.RandomState(np.random.randint(2**31)))
+
     def after_epoch(self):
-        "Randomly recompute elastic deformations"
-        self.learn.dls.train.on_epoch_end()
\ No newline at end of file
+        "Swap in the precomputed elastic deformations and start computing the next ones"
+        if self._in_workers:
+            self.learn.dls.train.dataset.epoch += 1
+            return
+        if self.next_augmentation is None: return self.learn.dls.train.on_epoch_end()
+        self.learn.dls.train.dataset.on_epoch_end(augmentation=self.next_augmentation.result())
+        self.next_augmentation = self._submit()
+
+    def after_cancel_fit(self):
+        "Do not compute the deformations of the next epoch if fitting is cancelled"
+        if self.next_augmentation is not None: self.next_augmentation.cancel()
+
+    def after_fit(self):
+        "Stop the background thread (also after `after_cancel_fit`)"
+        self.executor.shutdown(wait=False)
+        self.next_augmentation = None
\ No newline at end of file
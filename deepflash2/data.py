@@ -1,17 +1,23 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/02_data.ipynb (unless otherwise specified).
 
-__all__ = ['show', 'DeformationField', 'BaseDataset', 'RandomTileDataset', 'TileDataset']
+__all__ = ['show', 'DeformationField', 'BatchDeformation', 'LazyImage', 'ImageCache', 'BaseDataset', 'RandomTileDataset', 'TileDataset',
+           'TileDataLoader']
 
 # Cell
-import os, zarr, cv2, imageio, shutil, numpy as np
-from joblib import Parallel, delayed
+import os, time, json, hashlib, threading, zarr, cv2, imageio, shutil, PIL.Image, numpy as np
+from joblib import Parallel, delayed, effective_n_jobs
+from joblib.externals.loky import get_reusable_executor
+from concurrent.futures import as_completed
+from functools import reduce
+from collections import OrderedDict
+from contextlib import contextmanager
 
 from scipy import ndimage
-from scipy.interpolate import Rbf
-from scipy.interpolate import interp1d
+from scipy.interpolate import make_interp_spline
 
 from matplotlib.patches import Rectangle
 from skimage.measure import label
+from skimage.filters import threshold_otsu
 from skimage.color import label2rgb
 
 import torch, torch.nn as nn, torch.nn.functional as F
@@ -19,7 +25,7 @@ from torch.utils.data import Dataset, DataLoader
 
 from fastai.vision.all import *
 from fastcore.all import *
-from .transforms import random_center, WeightTransform, preprocess_mask, create_pdf
+from .transforms import random_center, CenterSampler, WeightTransform, preprocess_mask, create_pdf, calculate_weights
 
 import gc
 gc.enable()
@@ -129,6 +135,12 @@ def show_results(x:TensorImage, y:tuple, samples, outs, max_n=4, figsize=None, *
     if figsize is None: figsize = (12, max_n * 5)
     for i in range(max_n): show(x[i], y[0][i], outs[i][0], pred=True, figsize=figsize, **kwargs)
 
+# Cell
+def _interp_matrix(x, xi, k=3):
+    "Matrix that interpolates values at `x` to `xi` with a (cubic) spline"
+    if len(x)==1: return np.ones((len(xi), 1))
+    return make_interp_spline(x, np.eye(len(x)), k=min(k, len(x)-1))(xi)
+
 # Cell
 class DeformationField:
     "Creates a deformation field for data augmentation"
@@ -141,6 +153,14 @@ class DeformationField:
         self.deformationField = np.meshgrid(*grid_range)[::-1]
         self.orders = [cv2.INTER_NEAREST, cv2.INTER_LINEAR, cv2.INTER_CUBIC]
 
+    @property
+    def deformationField(self): return self._deformationField
+
+    @deformationField.setter
+    def deformationField(self, field):
+        # Precompiled remap maps (see `apply`) are only valid for the current field
+        self._deformationField, self._maps = field, {}
+
     def rotate(self, theta=0, phi=0, psi=0):
         "Rotate deformation field"
         if len(self.shape) == 2:
@@ -175,19 +195,19 @@ class DeformationField:
 
     def mirror(self, dims):
         "Mirror deformation fild at dims"
-        for d in range(len(self.shape)):
-            if dims[d]:
-                self.deformationField[d] = -self.deformationField[d]
-
-    def addRandomDeformation(self, grid=(150, 150), sigma=(10, 10)):
-        "Add random deformation to the deformation field"
-        seedGrid = np.meshgrid(
-            *[np.arange(-g / 2, s + g / 2, g) for (g, s) in zip(grid, self.shape)]
-        )
-        seed = [np.random.normal(0, s, g.shape) for (g, s) in zip(seedGrid, sigma)]
-        defFcn = [Rbf(*seedGrid, s, function="cubic") for s in seed]
-        targetGrid = np.meshgrid(*map(np.arange, self.shape))
-        deformation = [f(*targetGrid) for f in defFcn]
+        self.deformationField = [-f if dims[d] else f for d, f in enumerate(self.deformationField)]
+
+    def addRandomDeformation(self, grid=(150, 150), sigma=(10, 10), rng=np.random):
+        "Add random deformation (drawn from `rng`) to the deformation field"
+        # Separable cubic spline interpolation of the random seeds on the coarse grid
+        dims = list(zip(grid, self.shape))
+        if len(dims)>1: dims[0], dims[1] = dims[1], dims[0] # 'xy' indexing of the deformation field (np.meshgrid)
+        interp = [_interp_matrix(np.arange(-g / 2, s + g / 2, g), np.arange(s)) for (g, s) in dims]
+        deformation = []
+        for s in sigma:
+            df = rng.normal(0, s, [m.shape[1] for m in interp])
+            for m in interp: df = np.tensordot(df, m, axes=(0, 1))
+            deformation.append(df)
         self.deformationField = [
             f + df for (f, df) in zip(self.deformationField, deformation)
         ]
@@ -210,35 +230,290 @@ class DeformationField:
             tile = ndimage.interpolation.map_coordinates(data, coords, order=order, mode="reflect").reshape(outshape)
         return tile.astype(data.dtype)
 
+    def _compile(self, pad=(0, 0), order=1):
+        "Fixed-point remap maps (relative to the window start) and window of the field, cached per `pad` and `order`"
+        if (pad, order) not in self._maps:
+            outshape = tuple(int(s - p) for (s, p) in zip(self.shape, pad))
+            coords = [np.squeeze(d).astype('float32').reshape(*outshape) for d in self.get(pad=pad)]
+            # Neighbors needed for interpolation
+            margin = 1 if order==cv2.INTER_CUBIC else 0
+            start = [int(np.floor(c.min()))-margin for c in coords]
+            stop = [int(np.floor(c.max()))+2+margin for c in coords]
+            map1, map2 = cv2.convertMaps(coords[1]-start[1], coords[0]-start[0], cv2.CV_16SC2, nninterpolation=order==cv2.INTER_NEAREST)
+            self._maps[(pad, order)] = (map1, map2 if order!=cv2.INTER_NEAREST else None, start, stop)
+        return self._maps[(pad, order)]
+
+    def _window(self, data_shape, offset=(0, 0), pad=(0, 0), order=1):
+        "Slices of the data read by `apply` and shift of the maps, tiles at the borders are reflected"
+        _, _, start, stop = self._compile(tuple(pad), order)
+        sl, shift = [], []
+        for lo, hi, offs, dmax in zip(start, stop, offset, data_shape):
+            lo, hi = lo+int(offs), hi+int(offs)
+            if lo<0: cmin, cmax = 0, max(-lo, hi)
+            elif hi>dmax: cmin, cmax = max(0, min(lo, 2*dmax-hi)), dmax
+            else: cmin, cmax = lo, hi
+            sl.append(slice(cmin, min(cmax, dmax)))
+            shift.append(lo-cmin)
+        return tuple(sl), shift
+
+    def window(self, data_shape, offset=(0, 0), pad=(0, 0), order=1):
+        "Slices of the data read by `apply`"
+        return self._window(data_shape, offset, pad, order)[0]
+
     def apply(self, data, offset=(0, 0), pad=(0, 0), order=1):
-        "Apply deformation field to image using interpolation"
-        outshape = tuple(int(s - p) for (s, p) in zip(self.shape, pad))
-        coords = [np.squeeze(d).astype('float32').reshape(*outshape) for d in self.get(offset, pad)]
+        "Apply deformation field to image using interpolation (`offset` in integer pixels)"
+        map1, map2, _, _ = self._compile(tuple(pad), order)
         # Get slices to avoid loading all data (.zarr files)
+        sl, shift = self._window(data.shape, offset, pad, order)
+        if any(shift): map1 = map1 + np.array(shift[::-1], dtype=map1.dtype)
+        # Read region only once (e.g., from zarr chunks or lazy images)
+        region = np.ascontiguousarray(data[sl[0], sl[1]])
+        if region.ndim==3 and region.shape[-1]>4:
+            # Packed groups of up to four channels
+            return np.dstack([cv2.remap(np.ascontiguousarray(region[..., c:c+4]), map1, map2, order, borderMode=cv2.BORDER_REFLECT)
+                              for c in range(0, region.shape[-1], 4)])
+        tile = cv2.remap(region, map1, map2, order, borderMode=cv2.BORDER_REFLECT)
+        return tile[..., None] if tile.ndim<region.ndim else tile
+
+# Cell
+class _Tiler:
+    "Extracts tiles of `shape` by slicing (views where possible), reflected only at the data borders"
+    def __init__(self, shape=(540, 540)):
+        self.shape = shape
+
+    def _bounds(self, offset=(0, 0), pad=(0, 0)):
+        start = [int(o) - s//2 + int(p/2) for (o, s, p) in zip(offset, self.shape, pad)]
+        return start, [st + s - p for (st, s, p) in zip(start, self.shape, pad)]
+
+    def window(self, data_shape, offset=(0, 0), pad=(0, 0), order=None):
+        "Slices of the data read by `apply`, including the parts that are reflected at the borders"
+        start, stop = self._bounds(offset, pad)
         sl = []
-        for i in range(len(coords)):
-            cmin, cmax = int(coords[i].min()), int(coords[i].max())
-            dmax = data.shape[i]
-            if cmin<0:
-                cmax = max(-cmin, cmax)
-                cmin = 0
-            elif cmax>dmax:
-                cmin = min(cmin, 2*dmax-cmax)
-                cmax = dmax
-                coords[i] -= cmin
-            else: coords[i] -= cmin
-            sl.append(slice(cmin, cmax))
-        if len(data.shape) == len(self.shape) + 1:
-            tile = np.empty((*outshape, data.shape[-1]))
-            for c in range(data.shape[-1]):
-                tile[..., c] = cv2.remap(data[sl[0],sl[1], c], coords[1],coords[0], interpolation=order, borderMode=cv2.BORDER_REFLECT)
+        for lo, hi, d in zip(start, stop, data_shape):
+            if lo<0: sl.append(slice(0, min(max(-lo, hi), d)))
+            elif hi>d: sl.append(slice(max(0, min(lo, 2*d-hi)), d))
+            else: sl.append(slice(lo, hi))
+        return tuple(sl)
+
+    def apply(self, data, offset=(0, 0), pad=(0, 0), order=None):
+        "Same as `DeformationField.apply` for an identity field (`order` is ignored)"
+        start, stop = self._bounds(offset, pad)
+        sl = self.window(data.shape, offset, pad)
+        tile = data[sl]
+        borders = [(max(-lo, 0), max(hi-d, 0)) for (lo, hi, d) in zip(start, stop, data.shape)]
+        if not any(b for border in borders for b in border): return tile
+        # Reflect the image (not only the tile) at its borders, then crop the tile
+        tile = np.pad(tile, borders + [(0, 0)]*(tile.ndim-len(borders)), mode='symmetric')
+        return tile[tuple(slice(lo-s.start+b, hi-s.start+b) for lo, hi, s, (b, _) in zip(start, stop, sl, borders))]
+
+def _get_tiler(shape, scale=1):
+    "Slicing tiler for identity grids, interpolating `DeformationField` otherwise"
+    field = DeformationField(shape, scale=scale)
+    if all(np.array_equal(f, np.round(f)) for f in field.deformationField) and scale==1: return _Tiler(shape)
+    return field
+
+# Cell
+class _RegionView:
+    "Array-like `data` that serves reads inside the preloaded region `sl` from memory"
+    def __init__(self, data, sl):
+        self.data, self.sl = data, sl
+        self.region = np.asarray(data[sl])
+        self.shape, self.dtype = data.shape, self.region.dtype
+
+    @property
+    def ndim(self): return len(self.shape)
+
+    def __getitem__(self, idx):
+        idx = idx if isinstance(idx, tuple) else (idx,)
+        if all(isinstance(i, slice) and i.step is None and r.start<=i.start and i.stop<=r.stop for i, r in zip(idx, self.sl)):
+            return self.region[tuple(slice(i.start-r.start, i.stop-r.start) for i, r in zip(idx, self.sl))]
+        return self.data[idx]
+
+def _covering_view(data, windows, max_factor=2.):
+    "Reads the region of `data` covering all `windows` once (lazy images, zarr arrays) if it is at most `max_factor` times their area"
+    if data is None or isinstance(data, np.ndarray) or len(windows)<2: return data
+    # Decoded images are sliced (and normalized) per tile
+    if isinstance(data, LazyImage) and isinstance(data.data, np.ndarray): return data
+    sl = tuple(slice(min(w[i].start for w in windows), max(w[i].stop for w in windows)) for i in range(len(windows[0])))
+    # Distant windows are read per tile, the memory is bounded by the tile size
+    _area = lambda w: np.prod([s.stop-s.start for s in w], dtype='float64')
+    if _area(sl) > max_factor*sum(_area(w) for w in windows): return data
+    return _RegionView(data, sl)
+
+# Cell
+class BatchDeformation(RandTransform):
+    "Per-sample rotation, mirroring, zoom, and elastic deformation of a batch (tiles, masks, and instance labels) using `grid_sample`"
+    split_idx, order = None, -10
+    def __init__(self, tile_shape=(540,540), padding=(184,184), flip=True, rotation_range_deg=(0, 360), deformation_grid=(150, 150),
+                 deformation_magnitude=(10, 10), p_zoom=0.75, zoom_sigma=0.1, precompute_weights=False, **kwargs):
+        super().__init__(p=1.)
+        store_attr('tile_shape, padding, flip, rotation_range_deg, deformation_grid, deformation_magnitude, p_zoom, zoom_sigma, precompute_weights')
+        if deformation_grid is not None:
+            self.interp = [torch.as_tensor(_interp_matrix(np.arange(-g / 2, s + g / 2, g), np.arange(s)), dtype=torch.float32)
+                           for (g, s) in zip(deformation_grid, tile_shape)]
+
+    def before_call(self, b, split_idx):
+        x = b[0] if isinstance(b, tuple) else b
+        # Only crops from `RandomTileDataset(batch_aug=True)` are deformed, validation tiles are passed through
+        self.do = tuple(x.shape[-2:])!=tuple(self.tile_shape)
+        if self.do: self.grid = self._sample_grid(x.size(0), x.shape[-2:], x.device)
+
+    def _sample_grid(self, bs, in_shape, device):
+        "Sampling grid (normalized coordinates) of random deformations for `bs` tiles cropped from inputs with `in_shape`"
+        coords = [torch.arange(s, dtype=torch.float32, device=device) - s/2 for s in self.tile_shape]
+        coords = torch.stack([coords[0][:,None].expand(*self.tile_shape), coords[1][None,:].expand(*self.tile_shape)])
+        # Affine part: zoom, mirroring and rotation
+        zoom = torch.ones(bs, device=device)
+        do_zoom = torch.rand(bs, device=device)<self.p_zoom
+        zoom[do_zoom] = 1 + self.zoom_sigma*torch.randn(int(do_zoom.sum()), device=device)
+        lo, hi = self.rotation_range_deg
+        theta = (lo + (hi - lo)*torch.rand(bs, device=device))*np.pi/180.
+        rot = torch.stack([torch.cos(theta), torch.sin(theta), -torch.sin(theta), torch.cos(theta)], dim=1).view(bs, 2, 2)
+        mirror = torch.ones(bs, 2, device=device)
+        if self.flip: mirror[torch.rand(bs, 2, device=device)<.5] = -1.
+        coords = torch.einsum('bij,jyx->biyx', rot*zoom[:,None,None]*mirror[:,None,:], coords)
+        # Elastic deformation: separable cubic spline interpolation of random seeds
+        if self.deformation_grid is not None:
+            m0, m1 = [m.to(device) for m in self.interp]
+            sigma = torch.as_tensor(self.deformation_magnitude, dtype=torch.float32, device=device)
+            seeds = torch.randn(bs, 2, m0.size(1), m1.size(1), device=device)*sigma[None,:,None,None]
+            coords = coords + torch.einsum('bdij,yi,xj->bdyx', seeds, m0, m1)
+        # Normalized coordinates (x, y) of the inputs (align_corners=False), tile center is input center
+        coords = torch.stack([(2*coords[:, d] + 1)/s for d, s in enumerate(in_shape)], dim=-1)
+        return coords.flip(-1)
+
+    def _sample(self, x, mode, pad=(0, 0)):
+        grid = self.grid[:, pad[0]//2:self.grid.size(1)-pad[0]//2, pad[1]//2:self.grid.size(2)-pad[1]//2]
+        return F.grid_sample(x, grid.to(x.dtype), mode=mode, padding_mode='reflection', align_corners=False)
+
+    def encodes(self, x:TensorImage):
+        return self._sample(x, 'bilinear')
+
+    def encodes(self, x:TensorMask):
+        return self._sample(x[:, None].float(), 'nearest', self.padding)[:, 0].type(x.dtype)
+
+    def encodes(self, x:torch.Tensor):
+        # Instance labels or precomputed loss weights
+        if self.precompute_weights: return self._sample(x[:, None].float(), 'bilinear', self.padding)[:, 0].type(x.dtype)
+        x = self._sample(x[:, None].float(), 'nearest', self.padding)[:, 0].type(x.dtype)
+        # Renumber the instances of each tile (see `_relabel_sequential`), ids missing in a tile would have infinite distances in `WeightTransform`
+        return torch.stack([torch.unique(o, return_inverse=True)[1] + (o.min()>0) for o in x]).type(x.dtype)
+
+# Cell
+class _ValueAugmentation:
+    "Quadratic intensity mapping through (0, `min_value`), (0.5, `mid_value`), (1, `max_value`)"
+    def __init__(self, min_value=0., mid_value=0.5, max_value=1.):
+        self.coef = np.polyfit([0., 0.5, 1.], [min_value, mid_value, max_value], 2).astype('float32')
+
+    def __call__(self, x):
+        x = np.asarray(x)
+        a, b, c = self.coef
+        return (a*x.astype('float32', copy=False) + b)*x + c
+
+# Cell
+class LazyImage:
+    "Lazy image handle that only reads and normalizes (0-1 range) the sliced region"
+    def __init__(self, data, divide=None, dtype='float32'):
+        self.data, self.divide, self.dtype = data, divide, np.dtype(dtype)
+
+    @property
+    def shape(self): return self.data.shape
+
+    @property
+    def ndim(self): return len(self.shape)
+
+    def __len__(self): return self.shape[0]
+
+    def __getitem__(self, sl):
+        x = np.asarray(self.data[sl]).astype(self.dtype)
+        if self.divide: x /= self.divide
+        return x
+
+    def __array__(self, dtype=None, copy=None):
+        x = self[...]
+        return x if dtype is None else x.astype(dtype)
+
+    def __repr__(self): return f'{self.__class__.__name__}(shape={self.shape}, dtype={self.dtype}, divide={self.divide})'
+
+# Cell
+class _OpenTiffs:
+    "Bounded LRU of open TIFF files, the least recently used files that are not being read are closed"
+    def __init__(self, max_open=64):
+        self.max_open = max_open
+        self._reset()
+
+    def _reset(self): self.lock, self.files = threading.Lock(), OrderedDict()
+    # Handles are process local, (forked or spawned) workers open their own
+    def __reduce__(self): return _OpenTiffs, (self.max_open,)
+    def __len__(self): return len(self.files)
+
+    @contextmanager
+    def __call__(self, path, level=0):
+        "Zarr view and axes of the TIFF at `path`"
+        import tifffile
+        key = (Path(path).as_posix(), level)
+        with self.lock:
+            if key in self.files: self.files.move_to_end(key)
+            else:
+                tif = tifffile.TiffFile(key[0])
+                self.files[key] = [tif, zarr.open(tif.aszarr(series=0, level=level), mode='r'), tif.series[0].axes, 0]
+            entry = self.files[key]
+            entry[3] += 1
+            idle = [k for k, v in self.files.items() if v[3]==0]
+            for k in idle[:max(len(self.files)-self.max_open, 0)]: self.files.pop(k)[0].close()
+        try: yield entry[1], entry[2]
+        finally:
+            with self.lock: entry[3] -= 1
+
+_open_tiffs = _OpenTiffs()
+if hasattr(os, 'register_at_fork'): os.register_at_fork(after_in_child=_open_tiffs._reset)
+
+class _LazyArray:
+    "Image view with shape (y, x, c) that reads tiles of (OME-)TIFF or chunks of zarr files, max projection along 'Z'"
+    def __init__(self, path, level=0):
+        self.path, self.level = Path(path), level
+        # zarr stores do not keep files open
+        self._zarr = zarr.open(self.path.as_posix(), mode='r') if self.path.suffix == '.zarr' else None
+        with self._open() as (data, self.axes):
+            self.shape = tuple(data.shape[self.axes.index(a)] for a in 'YX')
+            self.shape += (data.shape[self.axes.index(self.channel_axis)] if self.channel_axis else 1,)
+            self.dtype = data.dtype
+
+    @contextmanager
+    def _open(self):
+        if self._zarr is not None:
+            # assuming shape (z_dim, n_channel, y_dim, x_dim) for 4D data
+            yield self._zarr, 'ZCYX' if self._zarr.ndim==4 else 'YXC'[:self._zarr.ndim]
         else:
-            tile = cv2.remap(data[sl[0], sl[1]], coords[1], coords[0], interpolation=order, borderMode=cv2.BORDER_REFLECT)
-        return tile
+            # TIFF handles are not kept per image, many images would exceed the open files limit
+            with _open_tiffs(self.path, self.level) as (data, axes): yield data, axes
+
+    @property
+    def channel_axis(self): return next((a for a in self.axes if a in 'CS'), None)
+
+    def __getitem__(self, sl):
+        sl = tuple(slice(None) if s is Ellipsis else s for s in (sl if isinstance(sl, tuple) else (sl,)))
+        ys, xs, cs = sl + (slice(None),)*(3-len(sl))
+        idx = tuple({'Y':ys, 'X':xs}.get(a, slice(None) if a in ('Z', self.channel_axis) else 0) for a in self.axes)
+        with self._open() as (data, _): x = np.asarray(data[idx])
+        axes = [a for a, i in zip(self.axes, idx) if isinstance(i, slice)]
+        if 'Z' in axes:
+            x = x.max(axis=axes.index('Z'))
+            axes.remove('Z')
+        x = x.transpose([axes.index(a) for a in ('Y', 'X', self.channel_axis) if a in axes])
+        if self.channel_axis is None: x = x[..., None]
+        return x[..., cs]
 
 # Cell
-def _read_img(path, divide=None, **kwargs):
-    "Read image and normalize to 0-1 range"
+def _read_img(path, divide=None, lazy=False, native=False, dtype='float32', **kwargs):
+    "Read image and normalize to 0-1 range (`dtype`), `native` images are kept in their dtype and normalized on slicing"
+    if lazy and (path.suffix == '.zarr' or path.suffix.lower() in ['.tif', '.tiff']):
+        # Only sliced regions (tiles or chunks) will be read
+        try: img = _LazyArray(path)
+        except ImportError: return _read_img(path, divide=divide, native=native, dtype=dtype, **kwargs)
+        if divide is None and path.suffix != '.zarr' and np.issubdtype(img.dtype, np.integer):
+            divide = np.iinfo(img.dtype).max
+        return LazyImage(img, divide=divide, dtype=dtype)
     if path.suffix == '.zarr':
         img = zarr.convenience.open(path.as_posix())
         if len(img.shape)==4: # assuming shape (z_dim, n_channel, y_dim, x_dim)
@@ -247,15 +522,28 @@ def _read_img(path, divide=None, **kwargs):
     else:
         img = imageio.imread(path, **kwargs)
         if divide is None and img.max()>0:
-            img = img/np.iinfo(img.dtype).max
-        if divide is not None:
-            img = img/divide
+            divide = np.iinfo(img.dtype).max
         #assert img.max()<=1. and img.max()>.04, f'Check image loading, dividing by {divide}, max value is {img.max()}'
-        assert img.max()<=1., f'Check image loading, dividing by {divide}'
+        assert img.max()/(divide or 1)<=1., f'Check image loading, dividing by {divide}'
+        if img.ndim == 2: img = np.expand_dims(img, axis=2)
+        img = LazyImage(np.asarray(img), divide=divide, dtype=dtype)
+        return img if native else img[...]
     if img.ndim == 2:
         img = np.expand_dims(img, axis=2)
     return img
 
+# Cell
+def _read_img_shape(path):
+    "Read image shape (y, x, c) from file header without decoding the image"
+    if path.suffix == '.zarr' or path.suffix.lower() in ['.tif', '.tiff']:
+        return _read_img(path, lazy=True).shape
+    try:
+        with PIL.Image.open(path) as im:
+            # Palette images are converted to RGB(A) on reading
+            if im.mode != 'P': return (im.height, im.width, len(im.getbands()))
+    except: pass
+    return _read_img(path).shape
+
 # Cell
 def _read_msk(path, n_classes=2, instance_labels=False, **kwargs):
     "Read image and check classes"
@@ -274,21 +562,180 @@ def _read_msk(path, n_classes=2, instance_labels=False, **kwargs):
         assert len(np.unique(msk))<=n_classes, 'Check n_classes and provided mask'
     return msk
 
+# Cell
+def _file_hash(path, block_size=2**20):
+    "Content hash (md5) of file or directory (e.g., `.zarr`)"
+    path = Path(path)
+    files = sorted(f for f in path.rglob('*') if f.is_file()) if path.is_dir() else [path]
+    h = hashlib.md5()
+    for f in files:
+        if path.is_dir(): h.update(f.relative_to(path).as_posix().encode())
+        with open(f, 'rb') as fh:
+            for block in iter(lambda: fh.read(block_size), b''): h.update(block)
+    return h.hexdigest()
+
+def _cached_file_info(path, cache, fn=None, name='hash'):
+    "`fn(path)` (default: `_file_hash`) stored in `cache` (by path), recomputed only if size or modification time of `path` changed"
+    path, fn = Path(path), fn or _file_hash
+    # Directories (e.g., `.zarr`) may change without changing their modification time
+    if path.is_dir(): return fn(path)
+    st = path.stat()
+    k, stat = path.resolve().as_posix(), [st.st_size, st.st_mtime_ns]
+    if k not in cache or cache[k].get('stat')!=stat or name not in cache[k]: cache[k] = {'stat':stat, name:fn(path)}
+    return cache[k][name]
+
+# Cell
+class ImageCache:
+    "Persistent store of images in their native dtype, chunked and keyed by content hash with LRU eviction."
+    def __init__(self, path, max_size=50e9, chunks=(512,512)):
+        self.path, self.max_size, self.chunks = Path(path), max_size, chunks
+        self.root = zarr.group(self.path.as_posix())
+        self._arrays = {}
+        # Content hashes by path, recomputed only if the size or modification time of a file changed
+        self.hashes = dict(self.root.attrs.get('hashes', {}))
+
+    def key(self, file):
+        "Content hash of `file`"
+        return _cached_file_info(file, self.hashes)
+
+    def save_hashes(self):
+        "Persist the content hashes of the added files"
+        self.root.attrs['hashes'] = self.hashes
+
+    def add(self, file, **kwargs):
+        "Store image `file` (if not cached) and return its key"
+        key = self.key(file)
+        if key in self.root: self.touch(key)
+        else:
+            img = imageio.imread(file, **kwargs)
+            if img.ndim == 2: img = np.expand_dims(img, axis=2)
+            # Uncompressed chunks, a tile only reads the chunks it touches
+            arr = self.root.create_dataset(key, shape=img.shape, dtype=img.dtype, chunks=(*self.chunks, img.shape[-1]),
+                                           compressor=None, overwrite=True)
+            arr[:] = img
+            arr.attrs.update({'max':img.max().item(), 'last_access':time.time()})
+        return key
+
+    def get(self, key, divide=None):
+        "Get `LazyImage` of image `key`, normalized to 0-1 range"
+        # The access time is updated on the first read of each session, not for every tile
+        if key not in self._arrays: self.touch(key); self._arrays[key] = self.root[key]
+        arr = self._arrays[key]
+        if divide is None and arr.attrs['max']>0: divide = np.iinfo(arr.dtype).max
+        assert arr.attrs['max']/(divide or 1)<=1., f'Check image loading, dividing by {divide}'
+        return LazyImage(arr, divide=divide)
+
+    def touch(self, key):
+        "Update last access time of image `key`"
+        self.root[key].attrs['last_access'] = time.time()
+
+    @property
+    def size(self):
+        return sum(a.nbytes for _, a in self.root.arrays())
+
+    def evict(self, keep=()):
+        "Remove least recently used images until cache size is below `max_size`"
+        if self.max_size is None: return
+        arrays = sorted(self.root.arrays(), key=lambda x: x[1].attrs['last_access'])
+        size, evicted = sum(a.nbytes for _, a in arrays), set()
+        for key, arr in arrays:
+            if size<=self.max_size: break
+            if key in keep: continue
+            size -= arr.nbytes
+            del self.root[key]
+            self._arrays.pop(key, None)
+            evicted.add(key)
+        if evicted:
+            self.hashes = {k:v for k, v in self.hashes.items() if v.get('hash') not in evicted}
+            self.save_hashes()
+
+# Cell
+def _merge_moments(a, b):
+    "Combines count, mean, and sum of squared deviations of two partitions (Chan et al.)"
+    (na, ma, m2a), (nb, mb, m2b) = a, b
+    n = na + nb
+    if n==0: return a
+    delta = mb - ma
+    return n, ma + delta*nb/n, m2a + m2b + delta**2*na*nb/n
+
+def _image_moments(img, max_pixels=None, chunk_rows=512, seed=0):
+    "Per channel moments of `img` [H, W, C], read in chunks of rows and randomly subsampled to about `max_pixels`"
+    step = img.shape[0]*img.shape[1]/max_pixels if max_pixels else 1
+    # Random (not strided) pixels, strides alias with the image columns
+    rng = np.random.default_rng(seed)
+    moments = (0, 0., 0.)
+    for i in range(0, img.shape[0], chunk_rows):
+        x = np.asarray(img[i:i+chunk_rows], dtype='float64').reshape(-1, img.shape[-1])
+        if step>1: x = x[rng.integers(0, len(x), int(np.ceil(len(x)/step)))]
+        mean = x.mean(0)
+        moments = _merge_moments(moments, (len(x), mean, ((x-mean)**2).sum(0)))
+    return moments
+
+# Cell
+def _relabel_sequential(x):
+    "Maps the labels of `x` to 0..n (0 remains background)"
+    present = np.zeros(int(x.max())+1, dtype=bool)
+    present[x] = True
+    present[0] = True
+    return (np.cumsum(present)-1)[x]
+
+# Cell
+def _preproc_mask(name, label_path, ign, params, mask_dir):
+    "Preprocesses the mask of image `name` with `params` (see `BaseDataset._preproc_params`) and saves labels, pdf, and optionally instances and weights to `mask_dir`"
+    mask_dir, c = Path(mask_dir), params['n_classes']
+    if params['instance_labels']: clabels, instlabels = None, _read_msk(label_path, c, instance_labels=True)
+    else: clabels, instlabels = _read_msk(label_path, c), None
+    lbl = preprocess_mask(clabels, instlabels, n_dims=c, remove_overlap=params['remove_overlap'])
+    zarr.group((mask_dir/'labels').as_posix())[name] = lbl
+    # Name of the pdf, see `BaseDataset._name_fn`
+    zarr.group((mask_dir/'pdfs').as_posix())[f"{name}_{params['fbr']}"] = create_pdf(lbl, ignore=ign, fbr=params['fbr'], scale=512)
+    if 'instances' in params:
+        # Instance labels for the loss weights (see `WeightTransform`), warped with the tiles
+        _, zarr.group((mask_dir/'instances').as_posix())[name] = cv2.connectedComponents((lbl > 0).astype('uint8'), connectivity=4)
+    if 'weights' in params:
+        # Loss weights of the whole mask, warped with the tiles instead of `WeightTransform`
+        _, zarr.group((mask_dir/'weights').as_posix())[name], _ = calculate_weights(lbl, ignore=ign, n_dims=c, fbr=params['fbr'],
+                                                                                    **params['weights'])
+
+def _preproc_masks(jobs, params, mask_dir):
+    "Preprocesses the masks of `jobs` (image name, mask path, and ignore map)"
+    for name, label_path, ign in jobs: _preproc_mask(name, label_path, ign, params, mask_dir)
+
 # Cell
 class BaseDataset(Dataset):
     def __init__(self, files, label_fn=None, instance_labels = False, n_classes=2, divide=None, ignore={},remove_overlap=True,
-                 tile_shape=(540,540), padding=(184,184),preproc_dir=None, fbr=.1, n_jobs=-1, verbose=1, scale=1, loss_weights=True, **kwargs):
-        store_attr('files, label_fn, instance_labels, divide, n_classes, ignore, tile_shape, remove_overlap, padding, fbr, scale, loss_weights')
+                 tile_shape=(540,540), padding=(184,184),preproc_dir=None, fbr=.1, n_jobs=-1, verbose=1, scale=1, loss_weights=True,
+                 cache_images=False, max_cache_size=50e9, preproc_backend='loky', cache_instances=False,
+                 precompute_weights=False, bws=10, fds=10, bwf=10, **kwargs):
+        store_attr('files, label_fn, instance_labels, divide, n_classes, ignore, tile_shape, remove_overlap, padding, fbr, scale, loss_weights, cache_images, n_jobs, preproc_backend, cache_instances')
+        store_attr('precompute_weights, bws, fds, bwf')
         self.c = n_classes
+        self.lazy_images = {}
+        self.preproc_dir = Path(preproc_dir) if preproc_dir else None
         if label_fn is not None:
             if not preproc_dir: self.preproc_dir = Path(label_fn(files[0])).parent/'.cache'
-            else: self.preproc_dir = Path(preproc_dir)
-            self.labels = zarr.group((self.preproc_dir/'labels').as_posix())
-            self.pdfs = zarr.group((self.preproc_dir/'pdfs').as_posix())
+            # Datasets with different preprocessing parameters may share `preproc_dir`
+            params_hash = hashlib.md5(json.dumps(self._preproc_params(), sort_keys=True).encode()).hexdigest()
+            self.mask_dir = self.preproc_dir/f'masks_{params_hash[:8]}'
+            self.labels = zarr.group((self.mask_dir/'labels').as_posix())
+            self.pdfs = zarr.group((self.mask_dir/'pdfs').as_posix())
+            if cache_instances: self.instances = zarr.group((self.mask_dir/'instances').as_posix())
+            if precompute_weights: self.weights = zarr.group((self.mask_dir/'weights').as_posix())
             self._preproc(n_jobs, verbose)
-
-    def read_img(self, *args, **kwargs):
-        return _read_img(*args, **kwargs)
+        self.image_keys = {}
+        if cache_images:
+            if self.preproc_dir is None: self.preproc_dir = Path(files[0]).parent/'.cache'
+            self.image_cache = ImageCache(self.preproc_dir/'images', max_size=max_cache_size)
+            self._cache_images(n_jobs, verbose)
+
+    def read_img(self, file, *args, **kwargs):
+        if file.name in self.image_keys:
+            return self.image_cache.get(self.image_keys[file.name], *args, **kwargs)
+        if file.name in self.lazy_images: return self.lazy_images[file.name]
+        img = _read_img(file, *args, lazy=True, native=True, **kwargs)
+        # Keep handles of file-backed images, decoded images are released after use
+        if isinstance(img, LazyImage) and isinstance(img.data, _LazyArray): self.lazy_images[file.name] = img
+        return img
 
     def read_mask(self, *args, **kwargs):
         return _read_msk(*args, **kwargs)
@@ -299,38 +746,91 @@ class BaseDataset(Dataset):
 
     def _preproc_file(self, file):
         "Preprocesses and saves labels (msk), weights, and pdf."
-        label_path = self.label_fn(file)
-        if self.instance_labels:
-            clabels = None
-            instlabels = self.read_mask(label_path,  self.c, instance_labels=True)
-        else:
-            clabels = self.read_mask(label_path, self.c)
-            instlabels = None
+        _preproc_mask(file.name, self.label_fn(file), self.ignore.get(file.name), self._preproc_params(), self.mask_dir)
+
+    def _preproc_processes(self, files, n_jobs=-1, chunks_per_worker=4):
+        "Preprocesses `files` in chunks on a process pool, the workers write the results to `mask_dir`"
+        n_workers = min(effective_n_jobs(n_jobs), len(files))
+        chunk_size = int(np.ceil(len(files)/(chunks_per_worker*n_workers)))
+        executor = get_reusable_executor(max_workers=n_workers)
+        # Only the mask paths and ignore maps of a chunk are sent to the workers, not the dataset
+        jobs, params = [(f.name, self.label_fn(f), self.ignore.get(f.name)) for f in files], self._preproc_params()
+        futures = [executor.submit(_preproc_masks, jobs[i:i+chunk_size], params, self.mask_dir) for i in range(0, len(jobs), chunk_size)]
+        for future in progress_bar(as_completed(futures), total=len(futures), leave=False): future.result()
+
+    def _preproc_params(self):
+        "Parameters that define the preprocessed data"
+        params = {'n_classes':self.c, 'instance_labels':self.instance_labels, 'remove_overlap':self.remove_overlap, 'fbr':self.fbr}
+        if self.cache_instances: params['instances'] = True
+        if self.precompute_weights: params['weights'] = {'bws':self.bws, 'fds':self.fds, 'bwf':self.bwf}
+        return params
+
+    def _manifest_entry(self, file, hashes):
+        "Content hashes of mask and ignore map and preprocessing parameters of `file`"
+        # Only rehash masks that changed since the last run
+        mask_hash = _cached_file_info(self.label_fn(file), hashes)
         ign = self.ignore[file.name] if file.name in self.ignore else None
-        lbl = preprocess_mask(clabels, instlabels, n_dims=self.c, remove_overlap=self.remove_overlap)
-        self.labels[file.name] = lbl
-        self.pdfs[self._name_fn(file.name)] = create_pdf(lbl, ignore=ign, fbr=self.fbr, scale=512)
+        ign_hash = hashlib.md5(np.ascontiguousarray(ign).tobytes()).hexdigest() if ign is not None else None
+        return {'mask':mask_hash, 'ignore':ign_hash, 'params':self._preproc_params()}
 
     def _preproc(self, n_jobs=-1, verbose=0):
-        using_cache = False
-        preproc_queue=L()
-        for f in self.files:
-            try:
-                #lbl, wgt, pdf = _get_cached_data(self._cache_fn(f.name))
-                self.labels[f.name]
-                self.pdfs[self._name_fn(f.name)]
-                if not using_cache:
-                    if verbose>0: print(f'Using preprocessed masks from {self.preproc_dir}')
-                    using_cache = True
-            except:
-                if n_jobs==1:
-                    if verbose>0: print('Preprocessing', f.name)
-                    self._preproc_file(f)
-                else:
-                    preproc_queue.append(f)
+        manifest_path = self.mask_dir/'manifest.json'
+        manifest = json.loads(manifest_path.read_text()) if manifest_path.exists() else {}
+        cached, hashes = manifest.setdefault('files', {}), manifest.setdefault('hashes', {})
+        entries = Parallel(n_jobs=n_jobs, backend='threading')(delayed(self._manifest_entry)(f, hashes) for f in self.files)
+        # Bulk check of manifest and cached arrays
+        cached_labels, cached_pdfs = set(self.labels.array_keys()), set(self.pdfs.array_keys())
+        cached_instances = set(self.instances.array_keys()) if self.cache_instances else None
+        cached_weights = set(self.weights.array_keys()) if self.precompute_weights else None
+        preproc_queue = L(f for f, e in zip(self.files, entries)
+                          if cached.get(f.name)!=e or f.name not in cached_labels
+                          or self._name_fn(f.name) not in cached_pdfs
+                          or (self.cache_instances and f.name not in cached_instances)
+                          or (self.precompute_weights and f.name not in cached_weights))
+        if verbose>0 and len(preproc_queue)<len(self.files): print(f'Using preprocessed masks from {self.mask_dir}')
         if len(preproc_queue)>0:
             if verbose>0: print('Preprocessing', L([f.name for f in preproc_queue]))
-            _ = Parallel(n_jobs=n_jobs, verbose=verbose, backend='threading')(delayed(self._preproc_file)(f) for f in preproc_queue)
+            if n_jobs==1:
+                for f in preproc_queue: self._preproc_file(f)
+            elif self.preproc_backend=='threading':
+                _ = Parallel(n_jobs=n_jobs, verbose=verbose, backend='threading')(delayed(self._preproc_file)(f) for f in preproc_queue)
+            else:
+                self._preproc_processes(preproc_queue, n_jobs)
+        # Datasets (e.g., train and validation) may share the same cache
+        cached.update({f.name:e for f, e in zip(self.files, entries)})
+        manifest_path.write_text(json.dumps(manifest))
+
+    def _cache_images(self, n_jobs=-1, verbose=0):
+        "Writes images once to the persistent image cache (native dtype, chunked)"
+        files = [f for f in self.files if f.suffix != '.zarr']
+        if verbose>0: print(f'Caching images at {self.image_cache.path}')
+        keys = Parallel(n_jobs=n_jobs, backend='threading')(delayed(self.image_cache.add)(f) for f in files)
+        self.image_keys = {f.name:k for f, k in zip(files, keys)}
+        self.image_cache.save_hashes()
+        self.image_cache.evict(keep=keys)
+
+    def _label_sources(self, file):
+        "Preprocessed labels and (if cached) precomputed weights or instance labels of `file`"
+        if self.label_fn is None: return None, None
+        # Weights of albumentations tiles are calculated from the augmented labels
+        if not self.loss_weights or getattr(self, 'albumentations_tfms', None): return self.labels[file.name], None
+        if self.precompute_weights: return self.labels[file.name], self.weights[file.name]
+        return self.labels[file.name], self.instances[file.name] if self.cache_instances else None
+
+    def _instance_tile(self, inst, field, center, pad=(0, 0)):
+        "Warps the cached instance labels `inst` (nearest neighbor) and relabels them sequentially"
+        W = field.apply(inst, center, pad, order=0)
+        return _relabel_sequential(W)
+
+    def _weight_tile(self, src, field, center, pad=(0, 0)):
+        "Warps the precomputed loss weights (linear) or the cached instance labels `src`"
+        if self.precompute_weights: return field.apply(src, center, pad, order=1)
+        return self._instance_tile(src, field, center, pad)
+
+    @property
+    def _weight_order(self):
+        "Interpolation order of `_weight_tile`"
+        return 1 if self.precompute_weights else 0
 
     def get_data(self, files=None, max_n=None, mask=False):
         if files is not None:
@@ -371,19 +871,35 @@ class BaseDataset(Dataset):
         except: print(f"No temporary files to delete at {self.preproc_dir}")
 
     #https://stackoverflow.com/questions/60101240/finding-mean-and-standard-deviation-across-image-channels-pytorch/60803379#60803379
-    def compute_stats(self, max_samples=50):
-        "Computes mean and std from files"
-        print('Computing Stats...')
-        mean_sum, var_sum = 0., 0.
-        for i, f in enumerate(self.files, 1):
-            img = self.read_img(f, divide=self.divide)[:]
-            mean_sum += img.mean((0,1))
-            var_sum += img.var((0,1))
-            if i==max_samples:
-                print(f'Calculated stats from {i} files')
-                continue
-        self.mean = mean_sum/i
-        self.std = np.sqrt(var_sum/i)
+    def _stats_key(self, files, max_pixels, cache):
+        "Key of the stats of `files` from their content hashes (rehashed only if size or mtime changed)"
+        hashes = cache.setdefault('hashes', {})
+        file_hashes = Parallel(n_jobs=self.n_jobs, backend='threading')(delayed(_cached_file_info)(f, hashes) for f in files)
+        return hashlib.md5(json.dumps([file_hashes, str(self.divide), max_pixels]).encode()).hexdigest()
+
+    def compute_stats(self, max_samples=50, max_pixels=None, use_cache=True):
+        "Computes mean and std from (at most `max_samples`) files, optionally subsampled to about `max_pixels` per file"
+        files = self.files[:max_samples] if max_samples else self.files
+        cache_path = (self.preproc_dir or Path(files[0]).parent/'.cache')/'stats.json'
+        cache = json.loads(cache_path.read_text()) if use_cache and cache_path.exists() else {}
+        key = self._stats_key(files, max_pixels, cache) if use_cache else None
+        if key in cache.get('stats', {}):
+            print(f'Using cached stats from {cache_path}')
+            mean, std = [np.array(x) for x in cache['stats'][key]]
+        else:
+            print('Computing Stats...')
+            moments = Parallel(n_jobs=self.n_jobs, backend='threading')(
+                delayed(lambda f: _image_moments(self.read_img(f, divide=self.divide), max_pixels))(f) for f in files)
+            n, mean, m2 = reduce(_merge_moments, moments)
+            std = np.sqrt(m2/n)
+            print(f'Calculated stats from {len(files)} files')
+            if use_cache:
+                cache.setdefault('stats', {})[key] = [mean.tolist(), std.tolist()]
+                try:
+                    cache_path.parent.mkdir(parents=True, exist_ok=True)
+                    cache_path.write_text(json.dumps(cache))
+                except OSError: print(f'Could not save stats to {cache_path}')
+        self.mean, self.std = mean.astype('float32'), std.astype('float32')
         return ([self.mean], [self.std])
 
 # Cell
@@ -394,9 +910,22 @@ class RandomTileDataset(BaseDataset):
     n_inp = 1
     def __init__(self, *args, sample_mult=None, flip=True, rotation_range_deg=(0, 360), deformation_grid=(150, 150), deformation_magnitude=(10, 10),
                  value_minimum_range=(0, 0), value_maximum_range=(1, 1), value_slope_range=(1, 1), p_zoom=0.75, zoom_sigma=0.1,
-                 albumentations_tfms=None, **kwargs):
+                 albumentations_tfms=None, deformation_bank=None, batch_aug=False, seed=None, tiles_per_image=1, **kwargs):
+        # Precomputed weights would need to be transformed with the image, before preprocessing the masks
+        assert not (albumentations_tfms and kwargs.get('precompute_weights')), 'albumentations_tfms are not supported with precompute_weights'
         super().__init__(*args, **kwargs)
-        store_attr('sample_mult, flip, rotation_range_deg, deformation_grid, deformation_magnitude, value_minimum_range, value_maximum_range, value_slope_range, zoom_sigma, p_zoom, albumentations_tfms')
+        store_attr('sample_mult, flip, rotation_range_deg, deformation_grid, deformation_magnitude, value_minimum_range, value_maximum_range, value_slope_range, zoom_sigma, p_zoom, albumentations_tfms, deformation_bank, batch_aug, tiles_per_image')
+        # Seed of the augmentations in DataLoader workers, see `_sync_worker_epoch`
+        self.seed = seed if seed is not None else np.random.randint(2**31)
+        self.epoch, self._worker_epoch, self._loader_epoch = 0, None, None
+        if self.label_fn is not None:
+            keys = {self._name_fn(f.name):f.name for f in self.files}
+            self.sampler = CenterSampler({k:self.pdfs[k] for k in keys}, {k:self.labels[n].shape for k,n in keys.items()})
+        if batch_aug:
+            # Tiles are deformed after collation (`BatchDeformation`), crop inputs large enough for rotation, zoom and deformation
+            max_deform = 3*max(deformation_magnitude) if deformation_grid is not None else 0
+            self.crop_shape = tuple(int(np.ceil(t*np.sqrt(2)*(1+2*zoom_sigma)/2 + max_deform))*2 for t in self.tile_shape)
+            self.cropper = _get_tiler(self.crop_shape, self.scale)
 
         # Sample mulutiplier: Number of random samplings from augmented image
         if self.sample_mult is None:
@@ -405,7 +934,9 @@ class RandomTileDataset(BaseDataset):
             #msk_shape = np.array(lbl.shape[-2:])
             self.sample_mult = int(np.product(np.floor(msk_shape/tile_shape)))
 
-        self.on_epoch_end()
+        # Pregenerated deformation fields, a random field is drawn for each sample
+        if self.deformation_bank: self.bank = self._create_deformation_bank(self.deformation_bank)
+        self.set_augmentation(self.create_augmentation())
 
     def __len__(self):
         return len(self.files)*self.sample_mult
@@ -414,15 +945,44 @@ class RandomTileDataset(BaseDataset):
         idx = idx % len(self.files)
         if torch.is_tensor(idx):
             idx = idx.tolist()
+        self._sync_worker_epoch()
 
         img_path = self.files[idx]
-        img = self.read_img(img_path, divide=self.divide)
+        center, field = self.sampler(self._name_fn(img_path.name)), self._tile_field()
+        return self._get_tile(center, field, self.read_img(img_path, divide=self.divide), *self._label_sources(img_path))
+
+    def __getitems__(self, indices):
+        "Random tiles of `indices`, tiles of the same image are extracted from a single read of their covering region"
+        files, centers, fields = [], [], []
+        for idx in indices:
+            self._sync_worker_epoch()
+            files.append(self.files[int(idx) % len(self.files)])
+            centers.append(self.sampler(self._name_fn(files[-1].name)))
+            fields.append(self._tile_field())
+        pad = (0, 0) if self.batch_aug else self.padding
+        items = [None]*len(indices)
+        for f in dict.fromkeys(files):
+            group = [i for i, g in enumerate(files) if g==f]
+            img, lbl, inst = self.read_img(f, divide=self.divide), *self._label_sources(f)
+            img = _covering_view(img, [fields[i].window(img.shape, centers[i]) for i in group])
+            lbl_windows = [fields[i].window(lbl.shape, centers[i], pad, 0) for i in group]
+            inst_windows = [fields[i].window(lbl.shape, centers[i], pad, self._weight_order) for i in group]
+            lbl, inst = _covering_view(lbl, lbl_windows), _covering_view(inst, inst_windows)
+            for i in group: items[i] = self._get_tile(centers[i], fields[i], img, lbl, inst)
+        return items
+
+    def _tile_field(self):
+        "Deformation field (or cropper, see `batch_aug`) of the next tile"
+        if self.batch_aug: return self.cropper
+        return self._draw_deformation() if self.deformation_bank else self.deformationField
+
+    def _get_tile(self, center, field, img, lbl, inst=None):
         n_channels = img.shape[-1]
-
-        lbl, pdf  = self.labels[img_path.name], self.pdfs[self._name_fn(img_path.name)]
-        center = random_center(pdf[:], lbl.shape)
-        X = self.gammaFcn(self.deformationField.apply(img, center).flatten()).reshape((*self.tile_shape, n_channels))
-        Y = self.deformationField.apply(lbl, center, self.padding, 0)
+        pad, out_shape = ((0, 0), self.crop_shape) if self.batch_aug else (self.padding, self.tile_shape)
+        X = self.gammaFcn(field.apply(img, center)).reshape((*out_shape, n_channels))
+        Y = field.apply(lbl, center, pad, 0)
+        # Cached instance labels and weights are not transformed by albumentations
+        W = self._weight_tile(inst, field, center, pad) if inst is not None else None
         X1 = X.copy()
 
         if self.albumentations_tfms:
@@ -434,114 +994,275 @@ class RandomTileDataset(BaseDataset):
         Y = Y.astype('int64')
 
         if self.loss_weights:
-            _, W = cv2.connectedComponents((Y > 0).astype('uint8'), connectivity=4)
+            if W is None: _, W = cv2.connectedComponents((Y > 0).astype('uint8'), connectivity=4)
             return  TensorImage(X), TensorMask(Y), torch.Tensor(W)
         else:
             return  TensorImage(X), TensorMask(Y)
 
-    def on_epoch_end(self, verbose=False):
-
-        if verbose: print("Generating deformation field")
-        if np.random.random()<self.p_zoom: scale=self.scale*np.random.normal(1, self.zoom_sigma)
+    def _random_deformation(self, rng=np.random):
+        "Creates a random deformation field (rotation, mirroring, and elastic deformation)"
+        if rng.random()<self.p_zoom: scale=self.scale*rng.normal(1, self.zoom_sigma)
         else: scale=self.scale
-        self.deformationField = DeformationField(self.tile_shape, self.scale)
+        deformationField = DeformationField(self.tile_shape, self.scale)
 
         if self.rotation_range_deg[1] > self.rotation_range_deg[0]:
-            self.deformationField.rotate(
-                theta=np.pi * (np.random.random()
+            deformationField.rotate(
+                theta=np.pi * (rng.random()
                             * (self.rotation_range_deg[1] - self.rotation_range_deg[0])
                             + self.rotation_range_deg[0])
                             / 180.0)
 
         if self.flip:
-            self.deformationField.mirror(np.random.choice((True,False),2))
+            deformationField.mirror(rng.choice((True,False),2))
 
         if self.deformation_grid is not None:
-            self.deformationField.addRandomDeformation(
-                self.deformation_grid, self.deformation_magnitude)
+            deformationField.addRandomDeformation(
+                self.deformation_grid, self.deformation_magnitude, rng)
+        return deformationField
+
+    def _create_deformation_bank(self, n):
+        "Creates (or loads) `n` deformation fields stored in `preproc_dir`"
+        params = {'tile_shape':self.tile_shape, 'scale':self.scale, 'flip':self.flip, 'rotation_range_deg':self.rotation_range_deg,
+                  'deformation_grid':self.deformation_grid, 'deformation_magnitude':self.deformation_magnitude,
+                  'p_zoom':self.p_zoom, 'zoom_sigma':self.zoom_sigma}
+        key = hashlib.md5(json.dumps(params, sort_keys=True).encode()).hexdigest()
+        root = zarr.group((self.preproc_dir/'deformations').as_posix())
+        if key in root and root[key].shape[0]>=n: return root[key]
+        shape = (len(self.tile_shape), *self.tile_shape)
+        bank = root.zeros(key, shape=(n, *shape), chunks=(1, *shape), dtype='float32', compressor=None, overwrite=True)
+        for i in progress_bar(range(n), leave=False):
+            bank[i] = np.stack(self._random_deformation().deformationField)
+        return bank
+
+    def _draw_deformation(self):
+        "Draws a random deformation field from the deformation bank"
+        deformationField = copy(self.deformationField)
+        deformationField.deformationField = list(self.bank[np.random.randint(self.bank.shape[0])])
+        return deformationField
+
+    def _set_loader_epoch(self, epoch):
+        "Epoch of the `TileDataLoader` in a worker, (persistent) workers do not see `on_epoch_end` of the main process"
+        self._loader_epoch = epoch
+        self._sync_worker_epoch()
+
+    def _sync_worker_epoch(self):
+        "Derives the augmentations in DataLoader workers from a per-worker, per-epoch seeded generator"
+        info = torch.utils.data.get_worker_info()
+        if info is None: return
+        epoch = self.epoch if self._loader_epoch is None else self._loader_epoch
+        if epoch!=self._worker_epoch:
+            self._worker_epoch = epoch
+            np.random.seed(np.random.SeedSequence([self.seed, info.id, epoch]).generate_state(1)[0])
+            self.set_augmentation(self.create_augmentation())
+
+    def on_epoch_end(self, verbose=False, augmentation=None):
+        "Starts a new epoch with new (or precomputed, see `create_augmentation`) augmentations"
+        self.epoch += 1
+        self.set_augmentation(augmentation or self.create_augmentation(verbose))
+
+    def set_augmentation(self, augmentation):
+        "Sets deformation field and value augmentation of the epoch"
+        deformationField, self.gammaFcn = augmentation
+        if deformationField is not None: self.deformationField = deformationField
+
+    def create_augmentation(self, verbose=False, rng=np.random):
+        "Creates the augmentations of an epoch (deformation field and value augmentation) from `rng` (e.g., `np.random.RandomState`)"
+        deformationField = None
+        if not self.batch_aug:
+            if verbose: print("Generating deformation field")
+            deformationField = self._random_deformation(rng)
 
         if verbose: print("Generating value augmentation function")
         minValue = (self.value_minimum_range[0]
             + (self.value_minimum_range[1] - self.value_minimum_range[0])
-            * np.random.random())
+            * rng.random())
 
         maxValue = (self.value_maximum_range[0]
             + (self.value_maximum_range[1] - self.value_maximum_range[0])
-            * np.random.random())
+            * rng.random())
 
         intermediateValue = 0.5 * (
             self.value_slope_range[0]
             + (self.value_slope_range[1] - self.value_slope_range[0])
-            * np.random.random())
+            * rng.random())
 
-        self.gammaFcn = interp1d([0, 0.5, 1.0], [minValue, intermediateValue, maxValue], kind="quadratic")
+        return deformationField, _ValueAugmentation(minValue, intermediateValue, maxValue)
+
+# Cell
+_tile_dtype = np.dtype([('image', 'int32'), ('center', 'int32', (2,)), ('shape', 'int32', (2,)),
+                        ('start', 'int32', (2,)), ('stop', 'int32', (2,))])
+
+def _tile_grid(idx, data_shape, output_shape, scale=1):
+    "Tile index (one row per tile) for image `idx` with `data_shape`"
+    n_tiles = [max(1, int(np.ceil(s / o))) for s, o in zip(data_shape, output_shape)]
+    grid = [g.ravel() for g in np.meshgrid(*[np.arange(n) for n in n_tiles], indexing='ij')]
+    tiles = np.zeros(len(grid[0]), dtype=_tile_dtype)
+    tiles['image'] = idx
+    tiles['shape'] = data_shape
+    for d, (tIdx, o, s) in enumerate(zip(grid, output_shape, data_shape)):
+        tiles['center'][:, d] = ((tIdx + 0.5) * o*scale).astype('int32')
+        tiles['start'][:, d] = tIdx * o
+        tiles['stop'][:, d] = np.minimum((tIdx + 1) * o, s)
+    return tiles
+
+# Cell
+def _foreground_mask(img, downsample=16, threshold=0.01, chunk_rows=1024):
+    "Coarse mask (blocks of `downsample` pixels) of image regions with intensity variation or (Otsu) intensity above `threshold`"
+    rows, w = [], img.shape[1]
+    step = max(chunk_rows//downsample, 1)*downsample
+    for i in range(0, img.shape[0], step):
+        x = np.asarray(img[i:i+step], dtype='float32').mean(-1)
+        x = np.pad(x, ((0, -x.shape[0]%downsample), (0, -w%downsample)), mode='edge')
+        rows.append(x.reshape(x.shape[0]//downsample, downsample, -1, downsample).mean((1, 3)))
+    x = np.concatenate(rows)
+    # Local standard deviation of the block means, background is (nearly) constant
+    mean, sq = ndimage.uniform_filter(x, 3, mode='nearest'), ndimage.uniform_filter(x**2, 3, mode='nearest')
+    std = np.sqrt(np.clip(sq - mean**2, 0, None))
+    fg = std>threshold
+    # Uniform interior of large (bright) structures, if the Otsu classes of the block means differ by more than `threshold`
+    if x.max()-x.min()>threshold:
+        t = threshold_otsu(x)
+        if x[x>t].mean()-x[x<=t].mean()>threshold: fg |= x>t
+    return ndimage.binary_dilation(fg)
 
 # Cell
 class TileDataset(BaseDataset):
     "Pytorch Dataset that creates random tiles for validation and prediction on new data."
     n_inp = 1
-    def __init__(self, *args, val_length=None, val_seed=42, is_zarr=False, **kwargs):
+    def __init__(self, *args, val_length=None, val_seed=42, is_zarr=False, zero_copy=False, cache_plan=False,
+                 skip_background=False, bg_threshold=0.01, **kwargs):
         super().__init__(*args, **kwargs)
+        self.zero_copy, self.skip_background = zero_copy, skip_background
+        self._last_img = (None, None)
+        self._divides = {}
         self.output_shape = tuple(int(t - p) for (t, p) in zip(self.tile_shape, self.padding))
-        self.tiler = DeformationField(self.tile_shape, scale=self.scale)
-        self.image_indices = []
-        self.image_shapes = []
-        self.in_slices = []
-        self.out_slices = []
-        self.centers = []
+        self.tiler = _get_tiler(self.tile_shape, scale=self.scale)
         self.valid_indices = None
 
         if self.files[0].suffix == '.zarr' or is_zarr:
             self.data = zarr.open(self.files[0].parent.as_posix(), mode='r')
             is_zarr = True
-        else:
+        elif not zero_copy:
             root = zarr.group(store=zarr.storage.TempStore(), overwrite=True)
             self.data = root.create_group('data')
 
-        j = 0
-        for i, file in enumerate(progress_bar(self.files, leave=False)):
-            img = self.read_img(file, divide=self.divide)
-            if not is_zarr: self.data[file.name] = img
-            # Tiling
-            data_shape = tuple(int(x//self.scale) for x in img.shape[:-1])
-            for ty in range(max(1, int(np.ceil(data_shape[0] / self.output_shape[0])))):
-                for tx in range(max(1, int(np.ceil(data_shape[1] / self.output_shape[1])))):
-                    self.centers.append((int((ty + 0.5) * self.output_shape[0]*self.scale),
-                                        int((tx + 0.5) * self.output_shape[1]*self.scale)))
-                    self.image_indices.append(i)
-                    self.image_shapes.append(data_shape)
-                    sliceDef = tuple(slice(int(tIdx * o), int(min((tIdx + 1) * o, s))) for (tIdx, o, s) in zip((ty, tx), self.output_shape, data_shape))
-                    self.out_slices.append(sliceDef)
-                    sliceDef = tuple(slice(0, int(min((tIdx + 1) * o, s) - tIdx * o)) for (tIdx, o, s) in zip((ty, tx), self.output_shape, data_shape))
-                    self.in_slices.append(sliceDef)
-                    j += 1
+        # Images are opened in __getitem__ for zero_copy, only read shapes from file headers
+        if zero_copy: img_shapes = self._read_shapes(cache_plan)
+        else: img_shapes = Parallel(n_jobs=self.n_jobs, backend='threading')(
+            delayed(self._load_img)(f, is_zarr) for f in progress_bar(self.files, leave=False))
+
+        # Compact tile index, slices are derived on demand
+        tiles = [_tile_grid(i, tuple(int(x//self.scale) for x in img_shape[:-1]), self.output_shape, self.scale)
+                 for i, img_shape in enumerate(img_shapes)]
+        self.tiles = np.concatenate(tiles) if len(tiles)>0 else np.zeros(0, dtype=_tile_dtype)
+
+        # Background tiles are skipped, see `predict_tiles`
+        candidates = np.arange(len(self.tiles))
+        if skip_background: self.valid_indices = candidates = self.foreground_tiles(threshold=bg_threshold)
 
         if val_length:
-            if val_length>len(self.image_shapes):
-                print(f'Reducing validation from lenght {val_length} to {len(self.image_shapes)}')
-                val_length = len(self.image_shapes)
+            if val_length>len(candidates):
+                print(f'Reducing validation from lenght {val_length} to {len(candidates)}')
+                val_length = len(candidates)
             np.random.seed(val_seed)
-            choice = np.random.choice(len(self.image_indices), val_length, replace=False)
-            self.valid_indices = {i:idx for i, idx in  enumerate(choice)}
+            self.valid_indices = np.random.choice(candidates, val_length, replace=False)
+
+    @property
+    def image_indices(self): return self.tiles['image']
+
+    @property
+    def image_shapes(self): return self.tiles['shape']
+
+    @property
+    def centers(self): return self.tiles['center']
+
+    def get_slices(self, idx):
+        "Output (image) and input (tile) slices of tile `idx`"
+        start, stop = self.tiles['start'][idx], self.tiles['stop'][idx]
+        out_slice = tuple(slice(int(a), int(b)) for a, b in zip(start, stop))
+        in_slice = tuple(slice(0, int(b - a)) for a, b in zip(start, stop))
+        return out_slice, in_slice
+
+    def _load_img(self, file, is_zarr=False):
+        "Reads image (to temporary store, in its native dtype) and returns its shape"
+        img = self.read_img(file, divide=self.divide)
+        # File-backed images are tiled directly from file (or image cache)
+        if not (is_zarr or file.name in self.lazy_images or file.name in self.image_keys):
+            self.data[file.name] = img.data if isinstance(img, LazyImage) else img
+            self._divides[file.name] = getattr(img, 'divide', None)
+        return img.shape
+
+    def _read_shapes(self, cache_plan=False):
+        "Reads image shapes from file headers in parallel, optionally cached in `preproc_dir`"
+        cache_path = (self.preproc_dir or self.files[0].parent/'.cache')/'image_shapes.json'
+        cache = json.loads(cache_path.read_text()) if cache_plan and cache_path.exists() else {}
+        old_cache = dict(cache)
+        shapes = Parallel(n_jobs=self.n_jobs, backend='threading')(
+            delayed(_cached_file_info)(f, cache, lambda o: list(_read_img_shape(o)), 'shape') for f in self.files)
+        if cache_plan and cache!=old_cache:
+            try:
+                cache_path.parent.mkdir(parents=True, exist_ok=True)
+                cache_path.write_text(json.dumps(cache))
+            except OSError: print(f'Could not save image shapes to {cache_path}')
+        return [tuple(shape) for shape in shapes]
+
+    def foreground_tiles(self, downsample=16, threshold=0.01):
+        "Indices of the tiles whose output region overlaps the foreground (`_foreground_mask`) of their image"
+        # `_get_img` keeps the last decoded image for zero_copy, not thread-safe
+        read = (lambda f: self.read_img(f, divide=self.divide)) if self.zero_copy else self._get_img
+        masks = Parallel(n_jobs=self.n_jobs, backend='threading')(
+            delayed(lambda f: _foreground_mask(read(f), downsample, threshold))(f) for f in self.files)
+        keep = [masks[t['image']][tuple(slice(int(a*self.scale)//downsample, -(-int(b*self.scale)//downsample))
+                                        for a, b in zip(t['start'], t['stop']))].any() for t in self.tiles]
+        return np.flatnonzero(keep)
+
+    def _get_img(self, file):
+        if file.name in self.lazy_images or file.name in self.image_keys:
+            return self.read_img(file, divide=self.divide)
+        if self.zero_copy:
+            # Tiles are ordered by image, keep the last decoded image
+            if self._last_img[0] != file.name: self._last_img = (file.name, self.read_img(file, divide=self.divide))
+            return self._last_img[1]
+        # Normalized on tile extraction
+        return LazyImage(self.data[file.name], divide=self._divides.get(file.name))
 
     def __len__(self):
-        if self.valid_indices: return len(self.valid_indices)
-        else: return len(self.image_shapes)
+        if self.valid_indices is not None: return len(self.valid_indices)
+        else: return len(self.tiles)
 
     def __getitem__(self, idx):
         if torch.is_tensor(idx):
             idx = idx.tolist()
-        if self.valid_indices: idx = self.valid_indices[idx]
+        if self.valid_indices is not None: idx = self.valid_indices[idx]
         img_path = self.files[self.image_indices[idx]]
-        img = self.data[img_path.name]
-        centerPos = self.centers[idx]
+        return self._get_tile(idx, self._get_img(img_path), *self._label_sources(img_path))
+
+    def __getitems__(self, indices):
+        "Tiles of `indices`, the tiles of each image are extracted from a single read of their covering region"
+        indices = [int(self.valid_indices[i]) if self.valid_indices is not None else int(i) for i in indices]
+        items = [None]*len(indices)
+        for img_idx in dict.fromkeys(self.image_indices[idx] for idx in indices):
+            group = [i for i, idx in enumerate(indices) if self.image_indices[idx]==img_idx]
+            img_path = self.files[img_idx]
+            img, (lbl, inst) = self._get_img(img_path), self._label_sources(img_path)
+            centers = [tuple(self.centers[indices[i]]) for i in group]
+            img = _covering_view(img, [self.tiler.window(img.shape, c) for c in centers])
+            if lbl is not None:
+                lbl_windows = [self.tiler.window(lbl.shape, c, self.padding, 0) for c in centers]
+                inst_windows = [self.tiler.window(lbl.shape, c, self.padding, self._weight_order) for c in centers]
+                lbl, inst = _covering_view(lbl, lbl_windows), _covering_view(inst, inst_windows)
+            for i in group: items[i] = self._get_tile(indices[i], img, lbl, inst)
+        return items
+
+    def _get_tile(self, idx, img, lbl=None, inst=None):
+        centerPos = tuple(self.centers[idx])
         X = self.tiler.apply(img, centerPos)
-        X = X.transpose(2, 0, 1).astype('float32')
-        if self.label_fn is not None:
-            lbl = self.labels[img_path.name]
+        X = X.transpose(2, 0, 1).astype('float32', copy=False)
+        if lbl is not None:
             Y = self.tiler.apply(lbl, centerPos, self.padding, order=0).astype('int64')
             if self.loss_weights:
-                _, W = cv2.connectedComponents((Y > 0).astype('uint8'), connectivity=4)
+                if inst is not None: W = self._weight_tile(inst, self.tiler, centerPos, self.padding)
+                else: _, W = cv2.connectedComponents((Y > 0).astype('uint8'), connectivity=4)
                 return  TensorImage(X), TensorMask(Y), torch.Tensor(W)
             else:
                 return  TensorImage(X), TensorMask(Y)
@@ -557,14 +1278,43 @@ class TileDataset(BaseDataset):
         out_ll = []
         for idx in range(len(self)):
             outIdx = self.image_indices[idx]
-            outShape = self.image_shapes[idx]
-            outSlice = self.out_slices[idx]
-            inSlice = self.in_slices[idx]
+            outShape = tuple(self.image_shapes[idx])
+            outSlice, inSlice = self.get_slices(idx)
             if len(out_ll) < outIdx + 1:
+                dtype = np.asarray(tiles[0]).dtype
                 if len(tiles[0].shape)>2:
-                    out_ll.append(np.empty((*outShape, self.c)))
+                    out_ll.append(np.empty((*outShape, self.c), dtype=dtype))
                 else:
-                    out_ll.append(np.empty(outShape))
+                    out_ll.append(np.empty(outShape, dtype=dtype))
             out_ll[outIdx][outSlice] = tiles[idx][inSlice]
 
-        return out_ll
\ No newline at end of file
+        return out_ll
+
+# Cell
+class TileDataLoader(TfmdDL):
+    "`TfmdDL` that extracts the tiles of a batch per image (`__getitems__`), optionally shuffling groups of `tiles_per_image` samples"
+    def shuffle_fn(self, idxs):
+        k = getattr(self.dataset, 'tiles_per_image', 1)
+        if k<=1: return super().shuffle_fn(idxs)
+        # RandomTileDataset: sample `idx` is drawn from image `idx % len(files)`
+        idxs = sorted(super().shuffle_fn(idxs), key=lambda i: i % len(self.dataset.files))
+        groups = [idxs[i:i+k] for i in range(0, len(idxs), k)]
+        return [i for g in super().shuffle_fn(groups) for i in g]
+
+    # Iterations of the loader in the main process and of the copy in a (persistent) worker
+    _epoch, _worker_epochs = -1, 0
+    def before_iter(self):
+        super().before_iter()
+        self._epoch += 1
+
+    def create_batches(self, samps):
+        if torch.utils.data.get_worker_info() is not None and hasattr(self.dataset, '_set_loader_epoch'):
+            self._worker_epochs += 1
+            self.dataset._set_loader_epoch(self._epoch + self._worker_epochs - 1)
+        if self.bs is None or not hasattr(self.dataset, '__getitems__'): return super().create_batches(samps)
+        return self._create_batches(samps)
+
+    def _create_batches(self, samps):
+        if self.dataset is not None: self.it = iter(self.dataset)
+        for b in self.chunkify(samps):
+            yield self.do_batch([self.after_item(o) for o in self.dataset.__getitems__(list(b))])
@@ -30,7 +30,7 @@ from .metrics import Dice_f1, Iou
 from .losses import WeightedSoftmaxCrossEntropy,load_kornia_loss
 from .callbacks import ElasticDeformCallback
 from .models import get_default_shapes, load_smp_model
-from .data import TileDataset, RandomTileDataset, _read_img, _read_msk
+from .data import TileDataset, RandomTileDataset, TileDataLoader, BatchDeformation, _read_img, _read_msk
 from .utils import iou, plot_results, get_label_fn, calc_iterations, save_mask, save_unc, compose_albumentations
 from .utils import compose_albumentations as _compose_albumentations
 import deepflash2.tta as tta
@@ -86,6 +86,7 @@ class Config:
     rot:int = 360
     deformation_grid:int = 150
     deformation_magnitude:int = 10
+    batch_aug:bool = False
 
     # Loss Settings Kornia
     loss_alpha:float = 0.5 # Twerksky/Focal loss
@@ -97,10 +98,14 @@ class Config:
     bws:int = 10
     fds:int = 10
     fbr:float = 0.5
+    precompute_weights:bool = False
 
     # Pred Settings
     pred_tta:bool = True
     extra_padding:int = 100
+    skip_background:bool = False
+    bg_threshold:float = 0.01
+    cache_plan:bool = False # Cache image shapes in '.cache' next to the prediction files
 
     # OOD Settings
     kernel:str = 'rbf'
@@ -177,8 +182,8 @@ def energy_max(e, ks=20, dim=None):
 # Cell
 @patch
 def predict_tiles(self:Learner, ds_idx=1, dl=None, path=None, mc_dropout=False, n_times=1, use_tta=False,
-                       tta_merge='mean', tta_tfms=None, uncertainty_estimates=True, energy_T=1):
-    "Make predictions and reconstruct tiles, optional with dropout and/or tta applied."
+                       tta_merge='mean', tta_tfms=None, uncertainty_estimates=True, energy_T=1, bg_smx=None, bg_energy=0.):
+    "Make predictions and reconstruct tiles, optional with dropout and/or tta applied. Skipped background tiles are filled with `bg_smx` and `bg_energy`."
 
     if dl is None: dl = self.dls[ds_idx].new(shuffled=False, drop_last=False)
     assert isinstance(dl.dataset, TileDataset), "Provide dataloader containing a TileDataset"
@@ -192,8 +197,29 @@ def predict_tiles(self:Learner, ds_idx=1, dl=None, path=None, mc_dropout=False,
     root = zarr.group(store=store, overwrite=True)
     g_smx, g_seg, g_std, g_eng  = root.create_groups('smx', 'seg', 'std', 'energy')
 
+    arrays = {}
+    def _get_arrays(idx):
+        f = dl.files[dl.image_indices[idx]]
+        if f.name not in arrays:
+            outShape = tuple(dl.image_shapes[idx])
+            arrays[f.name] = (g_smx.zeros(f.name, shape=(*outShape, dl.c), dtype='float32'),
+                              g_seg.zeros(f.name, shape=outShape, dtype='uint8'),
+                              g_std.zeros(f.name, shape=outShape, dtype='float32'),
+                              g_eng.zeros(f.name, shape=outShape, dtype='float32'))
+        return arrays[f.name]
+
+    # Tiles of the dataset (subset without background tiles)
+    tile_idxs = dl.valid_indices if dl.valid_indices is not None else np.arange(len(dl.tiles))
+    if dl.skip_background:
+        bg_smx = np.eye(dl.c, dtype='float32')[0] if bg_smx is None else np.asarray(bg_smx, dtype='float32')
+        for idx in np.setdiff1d(np.arange(len(dl.tiles)), tile_idxs):
+            z_smx, z_seg, z_std, z_eng = _get_arrays(idx)
+            outSlice, _ = dl.get_slices(idx)
+            z_smx[outSlice] = np.broadcast_to(bg_smx, (*(sl.stop-sl.start for sl in outSlice), dl.c))
+            z_seg[outSlice] = np.argmax(bg_smx)
+            if uncertainty_estimates: z_eng[outSlice] = bg_energy
+
     i = 0
-    last_file = None
     for data in progress_bar(dl, leave=False):
         if isinstance(data, TensorImage): images = data
         else: images, _, _ = data
@@ -222,17 +248,9 @@ def predict_tiles(self:Learner, ds_idx=1, dl=None, path=None, mc_dropout=False,
         for j, preds in enumerate(zip(*ll)):
             if len(preds)==3: smx,std,eng = preds
             else: smx = preds[0]
-            idx = i+j
-            f = dl.files[dl.image_indices[idx]]
-            outShape = dl.image_shapes[idx]
-            outSlice = dl.out_slices[idx]
-            inSlice = dl.in_slices[idx]
-            if last_file!=f:
-                z_smx = g_smx.zeros(f.name, shape=(*outShape, dl.c), dtype='float32')
-                z_seg = g_seg.zeros(f.name, shape=outShape, dtype='uint8')
-                z_std = g_std.zeros(f.name, shape=outShape, dtype='float32')
-                z_eng = g_eng.zeros(f.name, shape=outShape, dtype='float32')
-                last_file = f
+            idx = tile_idxs[i+j]
+            z_smx, z_seg, z_std, z_eng = _get_arrays(idx)
+            outSlice, inSlice = dl.get_slices(idx)
             z_smx[outSlice] = smx[inSlice]
             z_seg[outSlice] = np.argmax(smx, axis=-1)[inSlice]
             if uncertainty_estimates:
@@ -308,6 +326,8 @@ class EnsembleLearner(GetAttr):
         ds_kwargs['flip'] = self.flip
         ds_kwargs['deformation_grid']= (self.deformation_grid,)*2
         ds_kwargs['deformation_magnitude'] = (self.deformation_magnitude,)*2
+        ds_kwargs['batch_aug'] = self.batch_aug
+        ds_kwargs['precompute_weights'] = self.precompute_weights
         if sum(self.albumentation_kwargs.values())>0:
             ds_kwargs['albumentation_tfms'] = self.compose_albumentations(**self.albumentation_kwargs)
         return ds_kwargs
@@ -336,7 +356,9 @@ class EnsembleLearner(GetAttr):
             ds.append(TileDataset(files_val, label_fn=self.label_fn, **self.mw_kwargs,**self.ds_kwargs))
         else:
             ds.append(ds[0])
-        dls = DataLoaders.from_dsets(*ds, bs=self.bs, after_item=self.item_tfms, after_batch=self.get_batch_tfms(), **self.dl_kwargs)
+        after_batch = self.get_batch_tfms()
+        if self.batch_aug: after_batch.append(BatchDeformation(**self.ds_kwargs))
+        dls = DataLoaders.from_dsets(*ds, bs=self.bs, after_item=self.item_tfms, after_batch=after_batch, dl_type=TileDataLoader, **self.dl_kwargs)
         if torch.cuda.is_available(): dls.cuda()
         return dls
 
@@ -368,7 +390,8 @@ class EnsembleLearner(GetAttr):
     def get_batch_tfms(self):
         self.stats = self.stats or self.ds.compute_stats()
         tfms = [Normalize.from_stats(*self.stats)]
-        if isinstance(self.loss_fn, WeightedSoftmaxCrossEntropy):
+        # Precomputed weights are loaded with the tiles
+        if isinstance(self.loss_fn, WeightedSoftmaxCrossEntropy) and not self.precompute_weights:
             tfms.append(WeightTransform(self.out_size, **self.mw_kwargs))
         return tfms
 
@@ -412,8 +435,9 @@ class EnsembleLearner(GetAttr):
         ds_kwargs = self.ds_kwargs
         # Adding extra padding (overlap) for models that have the same input and output shape
         if ds_kwargs['padding'][0]==0: ds_kwargs['padding'] = (self.extra_padding,)*2
-        ds = TileDataset(files, **ds_kwargs)
-        dls = DataLoaders.from_dsets(ds, batch_size=self.bs, after_batch=self.get_batch_tfms(), shuffle=False, drop_last=False, **self.dl_kwargs)
+        ds = TileDataset(files, zero_copy=True, cache_plan=self.cache_plan, skip_background=self.skip_background,
+                         bg_threshold=self.bg_threshold, **ds_kwargs)
+        dls = DataLoaders.from_dsets(ds, batch_size=self.bs, after_batch=self.get_batch_tfms(), shuffle=False, drop_last=False, dl_type=TileDataLoader, **self.dl_kwargs)
         if torch.cuda.is_available(): dls.cuda()
         learn = Learner(dls, model, loss_func=self.loss_fn)
         if self.mpt: learn.to_fp16()
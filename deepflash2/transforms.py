@@ -1,14 +1,28 @@
 # AUTOGENERATED! DO NOT EDIT! File to edit: nbs/02a_transforms.ipynb (unless otherwise specified).
 
-__all__ = ['preprocess_mask', 'create_pdf', 'random_center', 'calculate_weights', 'lambda_kernel', 'SeparableConv2D',
-           'WeightTransformSingle', 'WeightTransform']
+__all__ = ['preprocess_mask', 'create_pdf', 'random_center', 'CenterSampler', 'calculate_weights', 'lambda_kernel',
+           'SeparableConv2D', 'WeightTransformSingle', 'WeightTransform']
 
 # Cell
 import torch, cv2, numpy as np
 import torch.nn.functional as F
+from scipy import ndimage
 from fastcore.transform import DisplayedTransform
 from fastai.torch_core import TensorImage, TensorMask
 
+# Cell
+def _add_ridged_instances(labels, instlabels, c, instances, n_dims=2, objects=None):
+    "Adds `instances` (in order) as class `c` to `labels`, except for pixels adjacent to objects of class `c`"
+    objects = objects or ndimage.find_objects(instlabels)
+    for instance in instances:
+        if instance<1 or instance>len(objects) or objects[instance-1] is None: continue
+        # Bounding box of the instance, the (3x3) dilation only depends on a margin of one pixel
+        box = objects[instance-1]
+        outer = tuple(slice(max(s.start-1, 0), s.stop+1) for s in box)
+        inner = tuple(slice(s.start-o.start, s.stop-o.start) for s, o in zip(box, outer))
+        objectMaskDil = cv2.dilate((labels[outer] == c).astype('uint8'), kernel=np.ones((3,) * n_dims), iterations = 1)
+        labels[box][(instlabels[box] == instance) & (objectMaskDil[inner] == 0)] = c
+
 # Cell
 def preprocess_mask(clabels=None, instlabels=None, ignore=None, remove_overlap=True,
                      n_dims = 2, fbr=.1):
@@ -37,6 +51,9 @@ def preprocess_mask(clabels=None, instlabels=None, ignore=None, remove_overlap=T
                 nInstances -=1
                 instlabels[comps > 0] = comps[comps > 0] + nextInstance
                 nextInstance += nInstances
+        else: instlabels = np.asarray(instlabels[:])
+        # Bounding boxes of all instances
+        objects = ndimage.find_objects(instlabels)
 
         for c in classes:
             # Extract all instance labels of class c
@@ -48,10 +65,7 @@ def preprocess_mask(clabels=None, instlabels=None, ignore=None, remove_overlap=T
             dil = cv2.morphologyEx(il, cv2.MORPH_CLOSE, kernel=np.ones((3,) * n_dims))
             overlap_cand = np.unique(np.where(dil!=il, dil, 0))
             labels[np.isin(il, overlap_cand, invert=True)] = c
-
-            for instance in overlap_cand[1:]:
-                objectMaskDil = cv2.dilate((labels == c).astype('uint8'), kernel=np.ones((3,) * n_dims),iterations = 1)
-                labels[(instlabels == instance) & (objectMaskDil == 0)] = c
+            _add_ridged_instances(labels, instlabels, c, overlap_cand[1:], n_dims, objects)
     else:
         labels = clabels
 
@@ -83,11 +97,33 @@ def random_center(pdf, orig_shape, scale=512):
     cy = int(cy*orig_shape[1]/scale_y)
     return cx, cy
 
+# Cell
+class CenterSampler:
+    'Sample random centers from cumulated PDFs (see `create_pdf`) held in memory using binary search'
+    def __init__(self, pdfs, shapes, scale=512):
+        self.pdfs = {k:np.asarray(v[:], dtype='float32') for k,v in pdfs.items()}
+        self.shapes, self.scale = shapes, scale
+
+    def pdf_shape(self, key):
+        'Shape of the (resized) PDF of `key`'
+        orig_shape = self.shapes[key]
+        if orig_shape[0]<=self.scale: return tuple(orig_shape[:2])
+        return (self.scale, int((orig_shape[1]/orig_shape[0])*self.scale))
+
+    def __call__(self, key, n=None):
+        'Sample one center (or `n` centers as array) of `key`'
+        pdf, orig_shape, pdf_shape = self.pdfs[key], self.shapes[key], self.pdf_shape(key)
+        idx = np.minimum(np.searchsorted(pdf, np.asarray(np.random.random(n), dtype=pdf.dtype), side='right'), len(pdf)-1)
+        centers = np.stack(np.unravel_index(idx, pdf_shape), axis=-1)
+        centers = (centers*np.array(orig_shape[:2])/np.array(pdf_shape)).astype('int')
+        return centers if n is not None else tuple(centers)
+
 # Cell
 def calculate_weights(clabels=None, instlabels=None, ignore=None,
-                      n_dims = 2, bws=10, fds=10, bwf=10, fbr=.1):
+                      n_dims = 2, bws=10, fds=10, bwf=10, fbr=.1, truncate=6.):
     """
     Calculates the weights from the given mask (classlabels `clabels` or `instlabels`).
+    Distances are computed within `truncate` standard deviations (`bws`, `fds`) around each instance.
     """
 
     assert not (clabels is None and instlabels is None), "Provide either clabels or instlabels"
@@ -117,6 +153,8 @@ def calculate_weights(clabels=None, instlabels=None, ignore=None,
             nInstances -=1
             instlabels[comps > 0] = comps[comps > 0] + nextInstance
             nextInstance += nInstances
+    else: instlabels = np.asarray(instlabels[:])
+    objects = ndimage.find_objects(instlabels)
 
     for c in classes:
         # Extract all instance labels of class c
@@ -128,23 +166,21 @@ def calculate_weights(clabels=None, instlabels=None, ignore=None,
         dil = cv2.morphologyEx(il, cv2.MORPH_CLOSE, kernel=np.ones((3,) * n_dims))
         overlap_cand = np.unique(np.where(dil!=il, dil, 0))
         labels[np.isin(il, overlap_cand, invert=True)] = c
-
-        for instance in overlap_cand[1:]:
-            objectMaskDil = cv2.dilate((labels == c).astype('uint8'), kernel=np.ones((3,) * n_dims),iterations = 1)
-            labels[(instlabels == instance) & (objectMaskDil == 0)] = c
+        _add_ridged_instances(labels, instlabels, c, overlap_cand[1:], n_dims, objects)
 
         # Generate weights
-        min1dist = 1e10 * np.ones(labels.shape)
-        min2dist = 1e10 * np.ones(labels.shape)
+        # Beyond `radius` the weight terms are negligible (< exp(-truncate**2/2))
+        radius = int(np.ceil(truncate*max(bws, fds)))
+        min1dist = 1e10 * np.ones(labels.shape, dtype='float32')
+        min2dist = 1e10 * np.ones(labels.shape, dtype='float32')
         for instance in instances:
+            if instance<1 or instance>len(objects) or objects[instance-1] is None: continue
+            box = tuple(slice(max(s.start-radius, 0), s.stop+radius) for s in objects[instance-1])
             #dt2 = ndimage.morphology.distance_transform_edt(instlabels != instance)
-            dt = cv2.distanceTransform((instlabels != instance).astype('uint8'), cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
-            frgrd_dist += np.exp(-dt ** 2 / (2*fds ** 2))
-            min2dist = np.minimum(min2dist, dt)
-            newMin1 = np.minimum(min1dist, min2dist)
-            newMin2 = np.maximum(min1dist, min2dist)
-            min1dist = newMin1
-            min2dist = newMin2
+            dt = cv2.distanceTransform((instlabels[box] != instance).astype('uint8'), cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+            frgrd_dist[box] += np.exp(-dt ** 2 / (2*fds ** 2))
+            min2 = np.minimum(min2dist[box], dt)
+            min1dist[box], min2dist[box] = np.minimum(min1dist[box], min2), np.maximum(min1dist[box], min2)
         wghts += bwf * np.exp(-(min1dist + min2dist) ** 2 / (2*bws ** 2))
 
     # Set weight for distance to the closest foreground object
@@ -169,11 +205,35 @@ def lambda_kernel(ks, lmbda):
     d = torch.sqrt(x**2)
     return torch.exp(-d/lmbda)
 
+# Cell
+def _exp_filter(x, lmbda, dim=-1, block=32):
+    "Filters `x` (zero padded) along `dim` with the untruncated kernel exp(-|d|/lmbda) using causal and anti-causal recursions"
+    a = np.exp(-1/lmbda)
+    x = torch.transpose(x, dim, -1)
+    n = x.size(-1)
+    nb = -(-n//block)
+    xb = F.pad(x, (0, nb*block-n)).reshape(*x.shape[:-1], nb, block)
+    # Recursions within blocks as matrix products
+    k = torch.arange(block, dtype=x.dtype, device=x.device)
+    d = k.view(-1, 1) - k.view(1, -1)
+    causal = torch.exp(-d.abs()/lmbda) * (d>=0)
+    y_causal, y_anti = xb @ causal.T, xb @ (causal - torch.eye(block).to(x))
+    # Propagate the carries across blocks
+    for i in range(1, nb):
+        y_causal[..., i, :] += a**(k+1) * y_causal[..., i-1, -1:]
+    for i in range(nb-2, -1, -1):
+        y_anti[..., i, :] += a**(block-k) * (xb[..., i+1, :1] + y_anti[..., i+1, :1])
+    y = (y_causal + y_anti).reshape(*x.shape[:-1], nb*block)[..., :n]
+    return torch.transpose(y, dim, -1)
+
 # Cell
 class SeparableConv2D(torch.nn.Module):
-    'Apply kernel on a 2d Tensor as a sequence of 1-D convolution filters.'
-    def __init__(self, lmbda, channels, ks=73, padding_mode='constant'):
+    'Apply kernel on a 2d Tensor as a sequence of 1-D convolution filters (or recursive filters, `backend="iir"`).'
+    def __init__(self, lmbda, channels, ks=73, padding_mode='constant', backend='conv'):
         super().__init__()
+        assert backend in ('conv', 'iir'), "Select backend 'conv' or 'iir'"
+        assert backend=='conv' or padding_mode=='constant', "The 'iir' backend only supports zero (constant) padding"
+        self.lmbda, self.backend = lmbda, backend
 
         self.channels = channels # assuming same 2D dimensions for H/W
         ks = ks if ks % 2 == 1 else ks+1
@@ -188,6 +248,8 @@ class SeparableConv2D(torch.nn.Module):
     def forward(self, inp):
         'Apply 1d gaussian filter to 2d input.'
         # assuming shape [ROIS, H, W]
+        # Independent of `ks`, the kernel is not truncated
+        if self.backend=='iir': return _exp_filter(_exp_filter(inp, self.lmbda, -1), self.lmbda, -2)
         weight = self.weight.to(inp)
         for _ in range(2):
             inp = F.conv1d(F.pad(inp, self.padding, mode=self.padding_mode), weight=weight, groups=self.channels)
@@ -196,10 +258,10 @@ class SeparableConv2D(torch.nn.Module):
 
 # Cell
 class WeightTransformSingle(DisplayedTransform):
-    def __init__(self, channels, bws=10, fds=10, bwf=1, fbr=.1, lmbda=0.35, ks=73):
+    def __init__(self, channels, bws=10, fds=10, bwf=1, fbr=.1, lmbda=0.35, ks=73, backend='conv'):
         self.bws, self.fds, self.bwf, self.fbr= bws, fds, bwf, fbr
         self.channels, self.lmbda = channels, lmbda
-        self.filter = SeparableConv2D(self.lmbda, channels, ks=ks)
+        self.filter = SeparableConv2D(self.lmbda, channels, ks=ks, backend=backend)
         #print('Using real-time weight calculation.')
 
     def _distance_transform(self, x):
@@ -230,31 +292,39 @@ class WeightTransformSingle(DisplayedTransform):
 
 # Cell
 class WeightTransform(WeightTransformSingle):
-    def __init__(self, *args, **kwargs):
+    "Batch version of `WeightTransformSingle`, instances are processed in chunks of about `max_mem` bytes"
+    def __init__(self, *args, max_mem=256e6, **kwargs):
         super().__init__(*args, **kwargs)
+        self.max_mem = max_mem
+
+    def _instance_distances(self, x):
+        "Foreground distance, min and max distance over the instances 1..max of instance labels `x` (H, W)"
+        # Masks, padded and transposed filter outputs, and distances of a chunk
+        chunk = max(int(self.max_mem // (6*x.element_size()*x.numel())), 1)
+        fd = torch.zeros_like(x)
+        bw_min, bw_max = torch.full_like(x, float('inf')), torch.full_like(x, -float('inf'))
+        for ids in torch.arange(1, int(x.max())+1, device=x.device).split(chunk):
+            dt = self._distance_transform((x[None]==ids.view(-1, 1, 1).to(x)).to(x))
+            fd += torch.sum(torch.exp(-dt**2/(2*self.fds**2)), dim=0)
+            bw_min, bw_max = torch.min(bw_min, torch.min(dt, dim=0)[0]), torch.max(bw_max, torch.max(dt, dim=0)[0])
+        return fd, bw_min, bw_max
 
     def encodes(self, b:torch.Tensor):
         if isinstance(b, TensorImage) or isinstance(b, TensorMask): return b
         w_ll = []
         for x in b:
-            x = (torch.eye(int(x.max()+1))[x.type(torch.long)][...,1:]).to(x)
-            x = x.permute(2,0,1)
-            labels = (torch.sum(x, dim=0)>0)
-            wghts = self.fbr * torch.ones((self.channels,)*2).to(x)
-            if x.size(0)>0:
-                dt = self._distance_transform(x)
+            labels = x>0
+            wghts = self.fbr * torch.ones_like(x)
+            if labels.any():
+                fd, bw_min, bw_max = self._instance_distances(x)
 
                 # Foreground_dist
-                fd = torch.sum(torch.exp(-dt**2/(2*self.fds**2)), dim=0)
-                wghts[labels == 0] += (1-self.fbr)*fd[labels == 0]
+                wghts[~labels] += (1-self.fbr)*fd[~labels]
 
                 # Border Weights
-                bw_max = torch.max(dt, dim=0)[0]
-                bw_min = torch.min(dt, dim=0)[0]
                 wghts += self.bwf * torch.exp(-(bw_max + bw_min)**2/ (2*self.bws ** 2))
 
                 # Set foreground weights to 1
-                wghts[labels > 0] = 1.
+                wghts[labels] = 1.
             w_ll.append(wghts)
-        #assert x.device==torch.device(type='cpu')
-        return torch.stack(w_ll).to(x)
+        return torch.stack(w_ll)